@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import functools
 import numpy as np
 
 
@@ -25,12 +26,12 @@ def get_density_from_gridding(data_par, gridding_matrix):
     # density /= np.max(density)
     # density[density != 0] = 1/density[density != 0]
     density = gridding_matrix@density
-    density = 1/density
+    np.reciprocal(density, out=density)
     density = np.reshape(
         density,
         (data_par["num_proj"], data_par["num_reads"])
         )
-    return density.astype(data_par["DTYPE_real"])
+    return density.astype(data_par["DTYPE_real"], copy=False)
 
 
 def get_golden_angle_dcf(k):
@@ -55,10 +56,17 @@ def get_golden_angle_dcf(k):
         raise ValueError("Passed trajectory has the wrong "
                          "number of dumensions.")
 
+    return _golden_angle_ramp(nspokes, N).copy()
+
+
+@functools.lru_cache(maxsize=8)
+def _golden_angle_ramp(nspokes, N):
+    # The ramp only depends on the trajectory shape. The cached array is
+    # read-only, callers get a copy.
     w = np.abs(np.linspace(-N/2, N/2, N))/(N/2)  # ramp from -1...1
-    w = np.repeat(w, nspokes, 0)
     w *= (N * np.pi / 4) / nspokes
-    w = np.reshape(w, (N, nspokes)).T
+    w = np.tile(w, (nspokes, 1))
+    w.flags.writeable = False
     return w
 
 
@@ -2,10 +2,7 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import sys
-from rrsg_cgreco._helper_fun import nlinvns
 from rrsg_cgreco import linop
-import skimage.filters
-from scipy.ndimage.morphology import binary_dilation as dilate
 
 # Estimates sensitivities and complex image.
 # (see Martin Uecker: Image reconstruction by regularized nonlinear
@@ -99,6 +96,10 @@ def estimate_coil_sensitivities_SOS(data, trajectory, par):
          par["Data"]["image_dimension"]),
         dtype=par["Data"]["DTYPE"])
 
+    # Imported here to keep importing the package light.
+    import skimage.filters
+    from scipy.ndimage import binary_dilation as dilate
+
     FFT = linop.NUFFT(par=par, trajectory=trajectory)
 
     windowsize = par["Data"]["num_reads"]/10
@@ -151,6 +152,9 @@ def estimate_coil_sensitivities_NLINV(data, trajectory, par):
               image dimensions (dimX, dimY), number of coils (num_coils),
               sampling pos (num_reads) and read outs (num_proj).
     """
+    # Imported here as pyfftw is only needed for NLINV.
+    from rrsg_cgreco._helper_fun import nlinvns
+
     nlinv_newton_steps = 6
     nlinv_real_constr = False
 
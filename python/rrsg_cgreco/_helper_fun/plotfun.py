@@ -33,6 +33,24 @@ def get_square(x):
     return x_div[res], x // x_div[res]
 
 
+def get_augmentation(augm):
+    """
+    Resolve the function used to augment images before plotting.
+    Accepts a callable or the name of a numpy function,
+    e.g. 'np.log' or 'abs'.
+    :param augm:
+    :return:
+    """
+    if callable(augm):
+        return augm
+    module_name, fun_name = augm.split('.')[0], augm.split('.')[-1]
+    fun = getattr(np, fun_name, None)
+    if module_name not in ('np', 'numpy', fun_name) or not callable(fun):
+        raise ValueError(
+            f'Unknown augmentation {augm}, expected a numpy function.')
+    return fun
+
+
 def plot_sequence(image_list, **kwargs):
     # Input of either a 2d list of np.arrays.. or a 3d list of np.arrays..
     figsize = kwargs.get('figsize')
@@ -46,6 +64,8 @@ def plot_sequence(image_list, **kwargs):
     vmin = kwargs.get('vmin', None)
     ax_off = kwargs.get('ax_off', False)
     augm_ind = kwargs.get('augm', None)
+    if augm_ind:
+        augm_fun = get_augmentation(augm_ind)
     aspect_mode = kwargs.get('aspect', 'equal')
 
     debug = kwargs.get('debug', False)
@@ -83,7 +103,7 @@ def plot_sequence(image_list, **kwargs):
         for j, ii_gs in enumerate(i_gs.subgridspec(n_sub_row, n_sub_col)):
             ax = f.add_subplot(ii_gs)
             if augm_ind:
-                plot_img = eval('{fun}({var})'.format(fun=augm_ind, var=str('temp_img[j]')))
+                plot_img = augm_fun(temp_img[j])
             else:
                 plot_img = temp_img[j]
 
@@ -236,7 +236,7 @@ class NUFFT(Operator):
             dtype=self.DTYPE)
         for nc in range(self.num_coils):
             ogkspace[nc] = np.reshape(
-                self.gridding_mat_adj.dot(denscor_inp[nc].flatten()),
+                self.gridding_mat_adj.dot(denscor_inp[nc].ravel()),
                 (self.grid_size, self.grid_size)
                 )
 
@@ -281,7 +281,7 @@ class NUFFT(Operator):
             )
         for nc in range(self.num_coils):
             kspace[nc] = np.reshape(
-                self.gridding_mat.dot(ogkspace[nc].flatten()),
+                self.gridding_mat.dot(ogkspace[nc].ravel()),
                 (self.num_proj, self.num_reads)
                 )
         # Perform density compensation
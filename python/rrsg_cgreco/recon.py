@@ -3,9 +3,15 @@
 """Main skript to run CG SENSE."""
 import numpy as np
 import os
+import pathlib
 import h5py
 import argparse
+import collections
+import functools
+import hashlib
 import configparser
+import scipy.linalg
+import threading
 from rrsg_cgreco._helper_fun.density_compensation \
     import get_density_from_gridding
 from rrsg_cgreco._helper_fun.est_coils import estimate_coil_sensitivities
@@ -16,12 +22,62 @@ import errno
 DTYPE = np.complex64
 DTYPE_real = np.float32
 
+# Number of trajectories for which the gridding matrix and density
+# compensation are kept by compute_density_compensation. 0 disables caching.
+DENSITY_CACHE_SIZE = 4
+_DENSITY_CACHE = collections.OrderedDict()
+_DENSITY_CACHE_LOCK = threading.Lock()
+
+# Types of the known config file options, keyed by (section, option).
+# Options which are not listed are read as strings.
+_CONFIG_SCHEMA = {
+    ("Data", "precision"): str,
+    ("Data", "do_intensity_scale"): bool,
+    ("Data", "do_density_correction"): bool,
+    ("FFT", "kernelwidth"): int,
+    ("FFT", "kernellength"): int,
+    ("Optimizer", "tolerance"): float,
+    ("Optimizer", "lambda"): float,
+    ("Optimizer", "max_iter"): int,
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+    """
+    Build the command line parser.
+
+    The parser is only constructed once and shared by all callers, the
+    default values are passed to it by _get_args on every call.
+
+    Returns
+    -------
+        The argparse.ArgumentParser object
+    """
+    parser = argparse.ArgumentParser(description='CG Sense Reconstruction')
+    parser.add_argument(
+        '--config', dest='configfile',
+        help='Name of config file to use (assumed to be in the same folder). '
+             'If not specified, use default parameters.'
+             )
+    parser.add_argument(
+        '--datafile', dest='pathtofile',
+        help='Path to the h5 data file.'
+        )
+    parser.add_argument(
+        '--acc', type=int,
+        dest='undersampling_factor',
+        help='Desired undersampling factor.'
+        )
+    return parser
+
 
 def _get_args(
       configfile='.'+os.sep+'python'+os.sep+'default',
       pathtofile=(
           '.'+os.sep+'data'+os.sep+'rawdata_brain_radial_96proj_12ch.h5'),
-      undersampling_factor=1
+      undersampling_factor=1,
+      argv=None
       ):
     """
     Parse command line arguments.
@@ -39,27 +95,21 @@ def _get_args(
             Desired undersampling compared to the number of
             spokes provided in data.
             E.g. 1 uses all available spokes 2 every 2nd.
+        argv (list):
+            List of arguments to parse. Defaults to the command line
+            arguments, pass an empty list to only use the given defaults.
 
     Returns
     -------
         The parsed arguments as argparse object
     """
-    parser = argparse.ArgumentParser(description='CG Sense Reconstruction')
-    parser.add_argument(
-        '--config', default=configfile, dest='configfile',
-        help='Name of config file to use (assumed to be in the same folder). '
-             'If not specified, use default parameters.'
-             )
-    parser.add_argument(
-        '--datafile', default=pathtofile, dest='pathtofile',
-        help='Path to the h5 data file.'
-        )
-    parser.add_argument(
-        '--acc', default=undersampling_factor, type=int,
-        dest='undersampling_factor',
-        help='Desired undersampling factor.'
+    # Pass the defaults as a namespace to not modify the shared parser.
+    defaults = argparse.Namespace(
+        configfile=configfile,
+        pathtofile=pathtofile,
+        undersampling_factor=undersampling_factor
         )
-    args = parser.parse_args()
+    args = _build_parser().parse_args(argv, namespace=defaults)
     return args
 
 
@@ -67,6 +117,7 @@ def run(
       configfile='.'+os.sep+'python'+os.sep+'default',
       datafile='.'+os.sep+'data'+os.sep+'rawdata_brain_radial_96proj_12ch.h5',
       undersampling_factor=1,
+      argv=None
       ):
     """
     Run the CG reco of radial or spiral data.
@@ -84,11 +135,15 @@ def run(
             Desired undersampling compared to the number of
             spokes provided in data.
             E.g. 1 uses all available spokes 2 every 2nd.
+        argv (list):
+            List of arguments to parse. Defaults to the command line
+            arguments, pass an empty list to only use the given defaults.
     """
     args = _get_args(
         configfile,
         datafile,
-        undersampling_factor
+        undersampling_factor,
+        argv
         )
     _run_reco(args)
 
@@ -131,7 +186,7 @@ def read_data(
     -------
         rawdata (np.complex64):
             The rawdata array
-        trajectory (np.complex64):
+        trajectory (np.float32):
             The k-space trajectory
         noise_scan (np.complex64):
             The noise reference scan
@@ -158,23 +213,20 @@ def read_data(
     name = os.path.normpath(pathtofile)
     with h5py.File(name, 'r') as h5_dataset:
         if "heart" in name:
-            if undersampling_factor == 2:
-                trajectory = h5_dataset[data_trajectory_key][:, :, :33]
-                rawdata = h5_dataset[data_rawdata_key][:, :, :33, :]
-            elif undersampling_factor == 3:
-                trajectory = h5_dataset[data_trajectory_key][:, :, :22]
-                rawdata = h5_dataset[data_rawdata_key][:, :, :22, :]
-            elif undersampling_factor == 4:
-                trajectory = h5_dataset[data_trajectory_key][:, :, :11]
-                rawdata = h5_dataset[data_rawdata_key][:, :, :11, :]
-            else:
-                trajectory = h5_dataset[data_trajectory_key][...]
-                rawdata = h5_dataset[data_rawdata_key][...]
+            # The heart data is undersampled by keeping the first spokes.
+            spokes = slice({2: 33, 3: 22, 4: 11}.get(undersampling_factor))
         else:
-            trajectory = h5_dataset[data_trajectory_key][
-                :, :, ::undersampling_factor]
-            rawdata = h5_dataset[data_rawdata_key][
-                :, :, ::undersampling_factor, :]
+            spokes = slice(None, None, undersampling_factor)
+        trajectory = _read_hyperslab(
+            h5_dataset[data_trajectory_key],
+            (slice(None), slice(None), spokes),
+            dtype=DTYPE_real
+            )
+        rawdata = _read_hyperslab(
+            h5_dataset[data_rawdata_key],
+            (slice(None), slice(None), spokes, slice(None)),
+            dtype=DTYPE
+            )
         if noise_key in h5_dataset.keys():
             noise_scan = h5_dataset[noise_key][()]
         else:
@@ -190,25 +242,22 @@ def read_data(
         else:
             mask = None
 
-    # Squeeze dummy dimension and transpose to C-style ordering.
-    rawdata = np.squeeze(rawdata.T)
+    # Squeeze dummy dimension, the data is already in C-style ordering.
+    rawdata = np.squeeze(rawdata)
 
-    data_par = get_data_par(trajectory)
+    # get_data_par expects the trajectory in position/reads/projections
+    # order as stored in the file.
+    data_par = get_data_par(trajectory.T)
     if mask is not None:
         data_par["mask"] = mask
 
-    # Transpose trajectory to projections/reads/position order
-    trajectory = (
-      np.require(
-        (trajectory).T,
-        requirements='C'
-        )
-      )
-
     # Check if rawdata and trajectory dimensions match
     assert trajectory.shape[:-1] == rawdata.shape[-2:], \
         "Rawdata and trajectory should have the same number "\
         "of read/projection pairs."
+    # Everything downstream relies on single precision input data.
+    assert rawdata.dtype == DTYPE and trajectory.dtype == DTYPE_real, \
+        "Rawdata and trajectory should be read in single precision."
 
     if data_par['image_dimension'] < 10:
         image_dim = None
@@ -216,6 +265,86 @@ def read_data(
     return rawdata, trajectory, noise_scan, data_par, Coils
 
 
+def _read_hyperslab(dataset, selection, dtype=None):
+    """
+    Read a hyperslab of a .h5 dataset in reversed axis order.
+
+    The data is written once into a preallocated C-contiguous array with
+    the axes of the selection reversed, i.e. the transpose of the stored
+    data, and converted to the requested type on the way.
+    Contiguous, uncompressed datasets are memory mapped and sliced
+    directly. Otherwise the selection is read as one (possibly strided)
+    HDF5 hyperslab into a scratch array in stored order, which is then
+    transposed into the output, as HDF5 cannot transpose while reading.
+    Strided reads from chunked files still read and decompress every chunk
+    overlapping the selection. If the chunk layout spans many spokes,
+    rechunk once so each chunk holds a single spoke, e.g.
+    ``h5repack -l rawdata:CHUNK=1x512x1x12 in.h5 out.h5``.
+
+    Args
+    ----
+        dataset (h5py.Dataset):
+            The dataset to read from.
+        selection (tuple):
+            One slice per dimension of the dataset.
+        dtype (numpy.dtype):
+            Type of the returned array. Defaults to the type of the dataset.
+
+    Returns
+    -------
+        np.array:
+            The transposed selected part of the dataset.
+    """
+    if dtype is None:
+        dtype = dataset.dtype
+    shape = tuple(
+        len(range(*dim_selection.indices(dim_size)))
+        for dim_selection, dim_size in zip(selection, dataset.shape)
+        )
+    data = np.empty(shape[::-1], dtype=dtype)
+    mapped_dataset = _memory_map(dataset)
+    if mapped_dataset is not None:
+        np.copyto(data, mapped_dataset[selection].T)
+    else:
+        scratch = np.empty(shape, dtype=dtype)
+        dataset.read_direct(scratch, source_sel=selection)
+        np.copyto(data, scratch.T)
+    return data
+
+
+def _memory_map(dataset):
+    """
+    Memory map a .h5 dataset if its raw data is a plain array in the file.
+
+    Args
+    ----
+        dataset (h5py.Dataset):
+            The dataset to map.
+
+    Returns
+    -------
+        np.memmap:
+            The read-only mapped dataset, or None if the dataset is chunked,
+            compressed, stored externally, not yet allocated or its file
+            layout differs from the numpy representation.
+    """
+    offset = dataset.id.get_offset()
+    if (dataset.chunks is not None
+            or dataset.compression is not None
+            or dataset.external is not None
+            or dataset.file.driver != 'sec2'
+            or offset is None
+            or dataset.id.get_type().get_size() != dataset.dtype.itemsize):
+        return None
+    return np.memmap(
+        dataset.file.filename,
+        dtype=dataset.dtype,
+        mode='r',
+        offset=offset,
+        shape=dataset.shape
+        )
+
+
 def get_data_par(trajectory):
     """
     Create the dictionary `data_par`. Fill it with overgrid factor and iamge dimension
@@ -278,6 +407,9 @@ def setup_parameter_dict(
     This function reads in the parameters given in the configfile as well
     as some general information about the data and trajectory such as
     image size.
+    The precision option only sets the precision of the reconstruction,
+    rawdata and trajectory are always single precision as returned by
+    read_data.
 
     Args
     ----
@@ -297,47 +429,16 @@ def setup_parameter_dict(
             A dictionary storing reconstruction related parameters like
             number of coils and image dimension in 2D.
     """
-    # Create empty dict
-    parameter = {}
-    config = configparser.ConfigParser()
     ext = os.path.splitext(configfile)[-1]
     if ext != ".txt":
         configfile = configfile + '.txt'
     try:
-        config.read_file(open(configfile))
-        config.read(configfile)
+        parameter = _read_config(configfile)
     except FileNotFoundError as err:
         raise FileNotFoundError(
             "Given Path doesn't point to an existing config file:\n{0}".format(
                 err))
 
-    for section_key in config.sections():
-        parameter[section_key] = {}
-        for value_key in config[section_key].keys():
-            if "do_" in value_key:
-                try:
-                    parameter[section_key][value_key] = config.getboolean(
-                        section_key,
-                        value_key)
-                except ValueError:
-                    parameter[section_key][value_key] = config.get(
-                        section_key,
-                        value_key)
-            else:
-                try:
-                    parameter[section_key][value_key] = config.getint(
-                        section_key,
-                        value_key)
-                except ValueError:
-                    try:
-                        parameter[section_key][value_key] = config.getfloat(
-                            section_key,
-                            value_key)
-                    except ValueError:
-                        parameter[section_key][value_key] = config.get(
-                            section_key,
-                            value_key)
-
     # If this function is called without data_par argument
     # Then it can be fixed. No mask is added though.
     if data_par is None:
@@ -375,12 +476,49 @@ def setup_parameter_dict(
     return parameter
 
 
+def _read_config(configfile):
+    """
+    Read the config file into a dict of sections.
+
+    Args
+    ----
+        configfile (str):
+            path to configuration file
+
+    Returns
+    -------
+        dict:
+            One dict of typed options per config file section.
+    """
+    config = configparser.ConfigParser()
+    with open(configfile) as file:
+        config.read_file(file)
+
+    getters = {
+        bool: config.getboolean,
+        int: config.getint,
+        float: config.getfloat,
+        str: config.get
+        }
+    sections = {}
+    for section_key in config.sections():
+        sections[section_key] = {}
+        for value_key in config[section_key].keys():
+            value_type = _CONFIG_SCHEMA.get((section_key, value_key), str)
+            sections[section_key][value_key] = getters[value_type](
+                section_key,
+                value_key)
+    return sections
+
+
 def compute_density_compensation(parameter, trajectory):
     """
     Compensate for non uniform sampling density.
 
     This function computes the sampling density via gridding of ones and
     the correct intensity normalization of the NUFFT operator.
+    The results for the last DENSITY_CACHE_SIZE trajectories are cached,
+    see clear_density_cache.
 
     Args
     ----
@@ -390,6 +528,20 @@ def compute_density_compensation(parameter, trajectory):
         trajectory (np.array):
             The associated trajectory data
     """
+    # Reuse the result of a previous call with the same trajectory
+    # and gridding parameters.
+    cache_key = _density_cache_key(parameter, trajectory)
+    with _DENSITY_CACHE_LOCK:
+        cached = _DENSITY_CACHE.get(cache_key)
+        if cached is not None:
+            _DENSITY_CACHE.move_to_end(cache_key)
+    if cached is not None:
+        # The gridding matrix is shared, dens_cor is copied as callers may
+        # modify it in place.
+        parameter["FFT"]["gridding_matrix"] = cached[0]
+        parameter["FFT"]["dens_cor"] = cached[1].copy()
+        return
+
     # First setup a NUFFT with the given trajectroy
     FFT = linop.NUFFT(par=parameter,
                       trajectory=trajectory)
@@ -397,11 +549,60 @@ def compute_density_compensation(parameter, trajectory):
     parameter["FFT"]["gridding_matrix"] = FFT.gridding_mat
     # Grid a k-space of all ones to get an estimated density
     # and use it as density compensation
-    parameter["FFT"]["dens_cor"] = np.sqrt(
-        get_density_from_gridding(
-            parameter["Data"],
-            parameter["FFT"]["gridding_matrix"]
-            )
+    dens_cor = get_density_from_gridding(
+        parameter["Data"],
+        parameter["FFT"]["gridding_matrix"]
+        )
+    parameter["FFT"]["dens_cor"] = np.sqrt(dens_cor, out=dens_cor)
+
+    if DENSITY_CACHE_SIZE > 0:
+        cached_dens_cor = dens_cor.copy()
+        cached_dens_cor.flags.writeable = False
+        with _DENSITY_CACHE_LOCK:
+            _DENSITY_CACHE[cache_key] = (
+                parameter["FFT"]["gridding_matrix"],
+                cached_dens_cor
+                )
+            while len(_DENSITY_CACHE) > DENSITY_CACHE_SIZE:
+                _DENSITY_CACHE.popitem(last=False)
+
+
+def clear_density_cache():
+    """Release all cached gridding matrices and density compensations."""
+    with _DENSITY_CACHE_LOCK:
+        _DENSITY_CACHE.clear()
+
+
+def _density_cache_key(parameter, trajectory):
+    """
+    Build the density compensation cache key.
+
+    Args
+    ----
+        parameter (dict):
+            A dictionary storing reconstruction related parameters like
+           number of coils and image dimension in 2D.
+        trajectory (np.array):
+            The associated trajectory data
+
+    Returns
+    -------
+        tuple:
+            The trajectory digest and all parameters the gridding
+            matrix and density depend on.
+    """
+    trajectory = np.ascontiguousarray(trajectory)
+    return (
+        hashlib.sha1(trajectory).hexdigest(),
+        trajectory.shape,
+        trajectory.dtype.str,
+        parameter["Data"]["overgridfactor"],
+        parameter["Data"]["image_dimension"],
+        parameter["Data"]["grid_size"],
+        np.dtype(parameter["Data"]["DTYPE"]).str,
+        np.dtype(parameter["Data"]["DTYPE_real"]).str,
+        parameter["FFT"]["kernelwidth"],
+        parameter["FFT"]["kernellength"],
         )
 
 
@@ -429,40 +630,36 @@ def save_to_file(
          Console arguments passed to the script.
     """
     print("Saving results...")
-    outdir = ""
+    outdir = pathlib.Path('output') / 'python'
     if "heart" in args.pathtofile:
-        outdir += os.sep+'heart'
+        outdir = outdir / 'heart'
     elif "brain" in args.pathtofile:
-        outdir += os.sep+'brain'
-    if not os.path.exists('.'+os.sep+'output'+os.sep+'python'):
-        os.makedirs('output')
-    if not os.path.exists('.'+os.sep+'output'+os.sep+'python' + outdir):
-        os.makedirs('.'+os.sep+'output'+os.sep+'python' + outdir)
-    cwd = os.getcwd()
-    os.chdir('.'+os.sep+'output'+os.sep+'python' + outdir)
-    f = h5py.File(
+        outdir = outdir / 'brain'
+    outdir = outdir.absolute()
+    outdir.mkdir(parents=True, exist_ok=True)
+    filename = outdir / (
         "CG_reco_inscale_" + str(data_par["do_intensity_scale"]) + "_denscor_"
         + str(data_par["do_density_correction"]) +
         "_reduction_" + str(args.undersampling_factor)
-        + ".h5",
-        "w"
+        + ".h5"
         )
-    f.create_dataset(
-        "CG_reco",
-        result.shape,
-        dtype=DTYPE,
-        data=result
-        )
-    f.create_dataset(
-        "Coil_images",
-        single_coil_images.shape,
-        dtype=DTYPE,
-        data=single_coil_images
-        )
-    f.attrs["residuals"] = residuals
-    f.flush()
-    f.close()
-    os.chdir(cwd)
+    with h5py.File(filename, "w") as f:
+        # Store one image per chunk.
+        f.create_dataset(
+            "CG_reco",
+            result.shape,
+            dtype=DTYPE,
+            chunks=(1,) + result.shape[1:],
+            data=result
+            )
+        f.create_dataset(
+            "Coil_images",
+            single_coil_images.shape,
+            dtype=DTYPE,
+            chunks=(1,) + single_coil_images.shape[1:],
+            data=single_coil_images
+            )
+        f.attrs["residuals"] = residuals
 
 
 def _decor_noise(data, noise, par, coils=None):
@@ -494,22 +691,29 @@ def _decor_noise(data, noise, par, coils=None):
         return data, coils
     else:
         print("Performing noise decorrelation...")
-        if not np.allclose(noise.shape, par["num_coils"]):
-            cov = np.cov(np.reshape(noise, (par["num_coils"], -1)))
+        num_coils = par["num_coils"]
+        num_proj = par["num_proj"]
+        num_reads = par["num_reads"]
+        if not np.allclose(noise.shape, num_coils):
+            cov = np.cov(np.reshape(noise, (num_coils, -1)))
         else:
             cov = noise
         L = np.linalg.cholesky(cov)
-        invL = np.linalg.inv(L)
-        data = np.reshape(data, (par["num_coils"], -1))
-        data = invL@data
-        data = np.reshape(data,
-                          (par["num_coils"],
-                           par["num_proj"],
-                           par["num_reads"]))
+        # Apply the inverse of L by a triangular solve instead of
+        # explicitly inverting L.
+        data = scipy.linalg.solve_triangular(
+            L,
+            np.reshape(data, (num_coils, -1)),
+            lower=True,
+            check_finite=False)
+        data = np.reshape(data, (num_coils, num_proj, num_reads))
         if coils is not None:
             coilshape = coils.shape
-            coils = np.reshape(coils, (par["num_coils"], -1))
-            coils = invL@coils
+            coils = scipy.linalg.solve_triangular(
+                L,
+                np.reshape(coils, (num_coils, -1)),
+                lower=True,
+                check_finite=False)
             coils = np.reshape(coils,
                                coilshape)
         return data, coils
@@ -572,13 +776,17 @@ def _run_reco(args):
     # Data needs to be multiplied with the sqrt of dense_cor to assure that
     # forward and adjoint application of the NUFFT is adjoint with each other.
     # dens_cor itself is saved in the par dict as the sqrt.
+    # The weighted data is computed once and shared by the CG solver and
+    # the single coil images.
+    dens_cor = parameter["FFT"]["dens_cor"]
+    weighted_kspace_data = kspace_data * dens_cor
     recon_result, residuals = cgs.optimize(
-        data=kspace_data * parameter["FFT"]["dens_cor"]
+        data=weighted_kspace_data
         )
 
     # Single Coil images after FFT
     single_coil_images = cgs.operator.NUFFT.adjoint(
-        kspace_data * parameter["FFT"]["dens_cor"])
+        weighted_kspace_data)
 
     # Store results
     save_to_file(recon_result,
@@ -589,23 +797,4 @@ def _run_reco(args):
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='CG Sense Reconstruction')
-    parser.add_argument(
-        '--config',
-        default='.'+os.sep+'python'+os.sep+'default',
-        dest='configfile',
-        help='Path to the config file to use. '
-             'If not specified, use default parameters.'
-             )
-    parser.add_argument(
-        '--datafile',
-        default='.'+os.sep+'data'+os.sep+'rawdata_brain_radial_96proj_12ch.h5',
-        dest='pathtofile',
-        help='Path to the .h5 data file.'
-        )
-    parser.add_argument(
-        '--acc', default=1, type=int, dest='undersampling_factor',
-        help='Desired acceleration factor.'
-        )
-    args = parser.parse_args()
-    _run_reco(args)
+    run()
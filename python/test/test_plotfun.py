@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import numpy as np
+from rrsg_cgreco._helper_fun.plotfun import get_augmentation
+
+
+class Augmentation(unittest.TestCase):
+    def test_numpy_function(self):
+        self.assertIs(get_augmentation('np.log'), np.log)
+        self.assertIs(get_augmentation('numpy.abs'), np.abs)
+        self.assertIs(get_augmentation('angle'), np.angle)
+
+    def test_callable(self):
+        self.assertIs(get_augmentation(np.abs), np.abs)
+
+    def test_reject_non_numpy(self):
+        for augm in ['os.system', '__import__("os").system', 'np.foo']:
+            with self.assertRaises(ValueError):
+                get_augmentation(augm)
+
+    def test_reject_non_callable(self):
+        for augm in ['np.random', 'np.pi']:
+            with self.assertRaises(ValueError):
+                get_augmentation(augm)
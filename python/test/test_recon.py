@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import numpy as np
+import h5py
+import os
+import tempfile
+from rrsg_cgreco import recon
+
+
+def setupPar(par):
+    par["Data"] = {}
+    par["Data"]["overgridfactor"] = 2
+    par["Data"]["DTYPE"] = np.complex64
+    par["Data"]["DTYPE_real"] = np.float32
+    par["Data"]["num_coils"] = 2
+    par["Data"]["image_dimension"] = 16
+    par["Data"]["num_proj"] = 8
+    par["Data"]["num_reads"] = 32
+    par["Data"]["grid_size"] = 32
+
+    par["FFT"] = {}
+    par["FFT"]["kernelwidth"] = 5
+    par["FFT"]["kernellength"] = 1000
+
+
+def radial_trajectory(num_proj, num_reads, image_dim):
+    angles = np.arange(num_proj) * np.pi / num_proj
+    radius = np.linspace(-image_dim/2, image_dim/2, num_reads,
+                         endpoint=False)
+    trajectory = np.zeros((num_proj, num_reads, 3), dtype=np.float32)
+    trajectory[..., 0] = np.cos(angles)[:, None] * radius
+    trajectory[..., 1] = np.sin(angles)[:, None] * radius
+    return trajectory
+
+
+class DensityCache(unittest.TestCase):
+    def setUp(self):
+        recon.clear_density_cache()
+        self.par = {}
+        setupPar(self.par)
+        self.trajectory = radial_trajectory(
+            self.par["Data"]["num_proj"],
+            self.par["Data"]["num_reads"],
+            self.par["Data"]["image_dimension"])
+
+    def tearDown(self):
+        recon.clear_density_cache()
+
+    def _compute(self, par=None, trajectory=None):
+        if par is None:
+            par = {}
+            setupPar(par)
+        if trajectory is None:
+            trajectory = self.trajectory
+        recon.compute_density_compensation(par, trajectory)
+        return par
+
+    def test_hit_same_trajectory(self):
+        first = self._compute()
+        second = self._compute(trajectory=self.trajectory.copy())
+        self.assertIs(first["FFT"]["gridding_matrix"],
+                      second["FFT"]["gridding_matrix"])
+        np.testing.assert_array_equal(first["FFT"]["dens_cor"],
+                                      second["FFT"]["dens_cor"])
+
+    def test_dens_cor_is_writeable_copy(self):
+        first = self._compute()
+        expected = first["FFT"]["dens_cor"].copy()
+        first["FFT"]["dens_cor"] *= 2
+        second = self._compute()
+        self.assertIsNot(first["FFT"]["dens_cor"], second["FFT"]["dens_cor"])
+        np.testing.assert_array_equal(second["FFT"]["dens_cor"], expected)
+        second["FFT"]["dens_cor"] *= 2
+
+    def test_miss_kernelwidth(self):
+        first = self._compute()
+        par = {}
+        setupPar(par)
+        par["FFT"]["kernelwidth"] = 3
+        second = self._compute(par=par)
+        self.assertIsNot(first["FFT"]["gridding_matrix"],
+                         second["FFT"]["gridding_matrix"])
+
+    def test_miss_trajectory(self):
+        first = self._compute()
+        trajectory = self.trajectory.copy()
+        trajectory[0, 0, 0] += 0.5
+        second = self._compute(trajectory=trajectory)
+        self.assertIsNot(first["FFT"]["gridding_matrix"],
+                         second["FFT"]["gridding_matrix"])
+
+    def test_disabled(self):
+        cache_size = recon.DENSITY_CACHE_SIZE
+        recon.DENSITY_CACHE_SIZE = 0
+        try:
+            first = self._compute()
+            second = self._compute()
+        finally:
+            recon.DENSITY_CACHE_SIZE = cache_size
+        self.assertIsNot(first["FFT"]["gridding_matrix"],
+                         second["FFT"]["gridding_matrix"])
+
+
+class ReadConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.configfile = os.path.join(self.tmpdir.name, 'config.txt')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_config(self, max_iter):
+        with open(self.configfile, 'w') as file:
+            file.write("[Optimizer]\nmax_iter = %i\n" % max_iter)
+
+    def test_reread_after_rewrite(self):
+        # Rewritten within the same timestamp tick on purpose.
+        self._write_config(10)
+        modification_time = os.stat(self.configfile).st_mtime_ns
+        self.assertEqual(
+            recon._read_config(self.configfile)["Optimizer"]["max_iter"], 10)
+        self._write_config(20)
+        os.utime(self.configfile, ns=(modification_time, modification_time))
+        self.assertEqual(
+            recon._read_config(self.configfile)["Optimizer"]["max_iter"], 20)
+
+    def test_option_types(self):
+        configfile = '.'+os.sep+'python'+os.sep+'default.txt'
+        config = recon._read_config(configfile)
+        for (section_key, value_key), value_type in \
+                recon._CONFIG_SCHEMA.items():
+            self.assertIs(type(config[section_key][value_key]), value_type)
+
+
+class ReadHyperslab(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rawdata = (
+            np.random.randn(1, 16, 12, 3)
+            + 1j * np.random.randn(1, 16, 12, 3)
+            )
+        self.spoke_selections = [
+            slice(None),
+            slice(None, None, 2),
+            slice(None, None, 5),
+            slice(None, 4)
+            ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, name, **kwargs):
+        filename = os.path.join(self.tmpdir.name, name)
+        with h5py.File(filename, 'w') as file:
+            file.create_dataset('rawdata', data=self.rawdata, **kwargs)
+        return filename
+
+    def _check(self, filename, mapped):
+        with h5py.File(filename, 'r') as file:
+            dataset = file['rawdata']
+            self.assertEqual(recon._memory_map(dataset) is not None, mapped)
+            for spokes in self.spoke_selections:
+                selection = (slice(None), slice(None), spokes, slice(None))
+                data = recon._read_hyperslab(
+                    dataset,
+                    selection,
+                    dtype=np.complex64)
+                expected = dataset[selection].T.astype(np.complex64)
+                self.assertTrue(data.flags.c_contiguous)
+                self.assertEqual(data.dtype, np.complex64)
+                np.testing.assert_array_equal(data, expected)
+
+    def test_contiguous(self):
+        self._check(self._write('contiguous.h5'), mapped=True)
+
+    def test_chunked_compressed(self):
+        self._check(
+            self._write(
+                'chunked.h5',
+                chunks=(1, 16, 1, 3),
+                compression='gzip'),
+            mapped=False)